@@ -1,26 +1,116 @@
 #!/usr/bin/env python3
 
 import os
+import re
 import sys
+import math
 import time
 import json
+import queue
+import atexit
+import asyncio
 import logging
+import logging.handlers
+import select
 import sqlite3
 import subprocess
+import threading
 from datetime import datetime
-from typing import Dict, List, Tuple
-import pandas as pd
+from typing import Dict, List, Optional, Tuple
+from sklearn.base import clone
 from sklearn.ensemble import IsolationForest
 import numpy as np
+import joblib
 import shutil
 
+# Model template; _fit_model clones it and sizes max_samples to the window
+_ISO_FOREST = IsolationForest(n_estimators=64, contamination=0.1, random_state=42, n_jobs=1)
+
+# smart_data rows as read for prediction, straight from the cursor
+_SMART_ROW = np.dtype([
+    ('timestamp', np.int64),
+    ('attribute_id', np.int32),
+    ('value', np.int16),
+    ('raw_int', np.int64)
+])
+
+# Leading integer of smartctl's raw string, e.g. 36 in "36 (Min/Max 20/45)",
+# read the way SQLite's CAST(raw_value AS INTEGER) reads it
+_RAW_LEADING_INT = re.compile(r"\s*([+-]?\d+)")
+
+# Attributes whose raw value only ever grows with use (start/stop, power-on
+# hours, power cycles, retracts, load cycles, flying hours, LBAs written/read);
+# prediction works on their rate per hour instead of the running total
+_USAGE_COUNTERS = (4, 9, 12, 192, 193, 225, 240, 241, 242)
+
+# Attributes that move in normal use without counting errors: spin-up time,
+# temperatures and SSD wear levels
+_READINGS = (3, 177, 190, 194, 202, 231, 233)
+
+# Octal escapes for spaces and other separators in /proc/mounts, e.g. \040
+_MOUNTS_ESCAPE = re.compile(r"\\([0-7]{3})")
+
 class DiskSentry:
+    # SMART rows written per INSERT statement
+    INSERT_CHUNK_ROWS = 32
+    # Samples in the model's training window, and the fewest worth fitting on
+    HISTORY_SAMPLES = 1000
+    MIN_FIT_SAMPLES = 50
+    # Seconds between query planner statistics refreshes in monitor_loop
+    OPTIMIZE_INTERVAL = 86400
+    # Bumped whenever _setup_database has to convert an existing database
+    SCHEMA_VERSION = 1
+    # SMART attribute ids are 1-255; attributes carried over from version 0
+    # databases, which only recorded names, get ids above this so they never
+    # merge with an attribute reported since
+    LEGACY_ATTRIBUTE_ID = 256
+
     def __init__(self, config_path: str = "/etc/disksentry/config.json"):
         """Initialize DiskSentry with configuration."""
         self.logger = self._setup_logging()
         self.config = self._load_config(config_path)
         self.db_conn = self._setup_database()
         
+        # Multi-row INSERT statements for 1..32 rows, built once and reused
+        self._insert_smart_sql = {
+            n_rows: (
+                "INSERT INTO smart_data "
+                "(timestamp, device, attribute_id, value, threshold, raw_value, raw_int) VALUES "
+                + ", ".join(["(?, ?, ?, ?, ?, ?, ?)"] * n_rows)
+            )
+            for n_rows in range(1, self.INSERT_CHUNK_ROWS + 1)
+        }
+        
+        # Per-device Isolation Forest models, fitted once and refitted lazily
+        self._model_path = self.config["database_path"] + ".iforest"
+        self._model_lock = threading.Lock()
+        self._refitting = set()
+        self._models = self._load_models()
+        
+        # Running backup tasks, so a slow rsync never blocks the next poll
+        self._backup_tasks: Dict[str, asyncio.Task] = {}
+        
+        # Per-device report lines and when they were built (monotonic); dropped
+        # when a new prediction is committed and at most one interval old
+        self._report_blocks: Dict[str, Tuple[float, List[str]]] = {}
+        
+        # Device -> mount point, re-read only when the kernel signals a
+        # mount table change on /proc/mounts
+        self._mounts_file = open("/proc/mounts")
+        self._mounts_poll = select.poll()
+        self._mounts_poll.register(self._mounts_file, select.POLLPRI | select.POLLERR)
+        self._mounts = self._read_mounts()
+        self._partition_patterns: Dict[str, re.Pattern] = {}
+        
+    def close(self):
+        """Release the database connection, the /proc/mounts handle and the log listener."""
+        self.logger.removeHandler(self._log_handler)
+        atexit.unregister(self._log_listener.stop)
+        self._log_listener.stop()
+        self._mounts_poll.unregister(self._mounts_file)
+        self._mounts_file.close()
+        self.db_conn.close()
+
     def _setup_logging(self) -> logging.Logger:
         """Configure logging for DiskSentry."""
         logger = logging.getLogger("DiskSentry")
@@ -29,7 +119,15 @@ class DiskSentry:
         handler = logging.StreamHandler(sys.stdout)
         formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
         handler.setFormatter(formatter)
-        logger.addHandler(handler)
+        
+        # Records are queued and written by a listener thread, so a slow
+        # stdout (terminal, pipe, journald) never stalls the monitoring loop
+        log_queue = queue.SimpleQueue()
+        self._log_handler = logging.handlers.QueueHandler(log_queue)
+        logger.addHandler(self._log_handler)
+        self._log_listener = logging.handlers.QueueListener(log_queue, handler)
+        self._log_listener.start()
+        atexit.register(self._log_listener.stop)
         
         return logger
 
@@ -53,10 +151,10 @@ class DiskSentry:
                 json.dump(default_config, f, indent=4)
             return default_config
         except json.JSONDecodeError as e:
-            self.logger.error(f"Invalid JSON in configuration file {config_path}: {e}")
+            self.logger.error("Invalid JSON in configuration file %s: %s", config_path, e)
             raise
         except Exception as e:
-            self.logger.error(f"Unexpected error while loading configuration: {e}")
+            self.logger.error("Unexpected error while loading configuration: %s", e)
             raise
 
     def _setup_database(self) -> sqlite3.Connection:
@@ -66,212 +164,672 @@ class DiskSentry:
             conn = sqlite3.connect(self.config["database_path"])
             cursor = conn.cursor()
             
-            # Create tables if they don't exist
+            # WAL + NORMAL sync: commits no longer fsync the main database file
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            # Keep temp tables, a 20 MB page cache and up to 256 MB of the file
+            # mapping in memory
+            cursor.execute("PRAGMA temp_store=MEMORY")
+            cursor.execute("PRAGMA cache_size=-20000")
+            cursor.execute("PRAGMA mmap_size=268435456")
+            # Checkpoint the WAL back into the database every 1000 pages so a
+            # long-running monitor does not grow it without bound
+            cursor.execute("PRAGMA wal_autocheckpoint=1000")
+            
+            cursor.execute("BEGIN")
+            
+            # Version 0 databases (ISO-8601 local time strings, attribute
+            # names on every row) are moved aside and converted below
+            version = cursor.execute("PRAGMA user_version").fetchone()[0]
+            upgrade = version < self.SCHEMA_VERSION and cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'smart_data'"
+            ).fetchone() is not None
+            if upgrade:
+                cursor.execute("ALTER TABLE smart_data RENAME TO smart_data_old")
+                cursor.execute("ALTER TABLE disk_predictions RENAME TO disk_predictions_old")
+            
+            # Create tables if they don't exist; timestamps are unix epoch
+            # seconds, and attribute_defs labels SMART attribute ids with the
+            # name smartctl last reported for them
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS attribute_defs (
+                    id INTEGER PRIMARY KEY,
+                    name TEXT
+                )
+            ''')
+            
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS smart_data (
-                    timestamp TEXT,
+                    timestamp INTEGER,
                     device TEXT,
-                    attribute TEXT,
+                    attribute_id INTEGER REFERENCES attribute_defs (id),
                     value INTEGER,
                     threshold INTEGER,
-                    raw_value TEXT
+                    raw_value TEXT,
+                    raw_int INTEGER
                 )
             ''')
             
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS disk_predictions (
-                    timestamp TEXT,
+                    timestamp INTEGER,
                     device TEXT,
                     health_score REAL,
                     prediction_confidence REAL
                 )
             ''')
             
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS prediction_state (
+                    device TEXT PRIMARY KEY,
+                    last_ts INTEGER
+                )
+            ''')
+            
+            if upgrade:
+                timestamp = "CAST(strftime('%s', timestamp, 'utc') AS INTEGER)"
+                cursor.execute(f'''
+                    INSERT INTO attribute_defs (id, name)
+                    SELECT {self.LEGACY_ATTRIBUTE_ID} + ROW_NUMBER() OVER (ORDER BY attribute), attribute
+                    FROM (SELECT DISTINCT attribute FROM smart_data_old)
+                ''')
+                cursor.execute(f'''
+                    INSERT INTO smart_data
+                    SELECT {timestamp}, device, attribute_defs.id, value, threshold, raw_value,
+                           CAST(raw_value AS INTEGER)
+                    FROM smart_data_old
+                    JOIN attribute_defs ON attribute_defs.name = smart_data_old.attribute
+                ''')
+                cursor.execute("DROP TABLE smart_data_old")
+                cursor.execute(f'''
+                    INSERT INTO disk_predictions
+                    SELECT {timestamp}, device, health_score, prediction_confidence
+                    FROM disk_predictions_old
+                ''')
+                cursor.execute("DROP TABLE disk_predictions_old")
+                self.logger.info("Upgraded database from schema version %d.", version)
+            
+            # Created after the upgrade: renamed tables keep their index names.
+            # Latest-first lookups per device; the predictions index also
+            # covers the report columns so generate_report never reads the table
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_smart_device_ts
+                ON smart_data (device, timestamp DESC)
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_pred_device_ts
+                ON disk_predictions (device, timestamp DESC, health_score, prediction_confidence)
+            ''')
+            
+            cursor.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
             conn.commit()
+            cursor.execute("PRAGMA optimize")
             self.logger.info("Database initialized successfully.")
             return conn
         except sqlite3.Error as e:
-            self.logger.error(f"Database initialization error: {e}")
+            self.logger.error("Database initialization error: %s", e)
             raise
         
 
-    def get_smart_data(self, device: str) -> List[Dict]:
-        """Retrieve SMART data for a specific device using smartctl."""
+    async def _run(self, cmd: List[str], check: bool = True) -> subprocess.CompletedProcess:
+        """Run a command like subprocess.run, without blocking the event loop."""
+        process = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate()
+        stdout, stderr = stdout.decode(), stderr.decode()
+        
+        if check and process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, cmd, stdout, stderr)
+        return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+
+    async def get_smart_data(self, device: str) -> List[Dict]:
+        """
+        Retrieve SMART data for a specific device using smartctl's JSON output.
+        Identity, health, capabilities and attributes come from a single
+        smartctl run; disks in standby are skipped rather than spun up.
+        """
         try:
-            cmd = ["smartctl", "-A", device]
-            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+            cmd = ["smartctl", "-i", "-H", "-c", "-A", "-n", "standby,0", "-j", device]
+            result = await self._run(cmd, check=False)
             
-            smart_data = []
-            for line in result.stdout.split('\n')[2:]:  # Skip header lines
-                if line.strip():
-                    parts = line.split()
-                    if len(parts) >= 9:
-                        smart_data.append({
-                            'attribute': parts[1],
-                            'value': int(parts[3]),
-                            'threshold': int(parts[5]),
-                            'raw_value': parts[9]
-                        })
-            return smart_data
-        except subprocess.CalledProcessError as e:
-            self.logger.error(f"Failed to get SMART data for {device}: {e}")
+            # smartctl's exit status is a bit mask; bits 0-1 mean the command
+            # failed outright, higher bits report disk problems alongside data
+            if result.returncode & 0b11:
+                raise subprocess.CalledProcessError(result.returncode, cmd, result.stdout, result.stderr)
+            data = json.loads(result.stdout)
+            
+            if data.get('smart_status', {}).get('passed') is False:
+                self.logger.warning("SMART overall health self-assessment failed for %s", device)
+            
+            # No attribute table when the disk was in standby (or is not ATA)
+            return [
+                {
+                    'id': attribute['id'],
+                    'attribute': attribute['name'],
+                    'value': attribute['value'],
+                    'threshold': attribute['thresh'],
+                    'raw_value': attribute['raw']['string'],
+                    'raw_int': self._parse_raw(attribute['raw']['string'])
+                }
+                for attribute in data.get('ata_smart_attributes', {}).get('table', [])
+            ]
+        except (subprocess.CalledProcessError, json.JSONDecodeError) as e:
+            self.logger.error("Failed to get SMART data for %s: %s", device, e)
             return []
 
+    @staticmethod
+    def _parse_raw(raw: str) -> int:
+        """Leading integer of smartctl's raw string; raw.value packs the whole 48-bit field."""
+        match = _RAW_LEADING_INT.match(raw)
+        return int(match.group(1)) if match else 0
+
     def store_smart_data(self, device: str, smart_data: List[Dict]):
-        """Store SMART data in the database."""
-        cursor = self.db_conn.cursor()
-        timestamp = datetime.now().isoformat()
+        """
+        Store SMART data in the database.
+        Does not commit; callers wrap this in a `with self.db_conn:` transaction.
+        """
+        timestamp = int(time.time())
         
-        for attribute in smart_data:
-            cursor.execute('''
-                INSERT INTO smart_data
-                (timestamp, device, attribute, value, threshold, raw_value)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (
+        # Attributes are keyed by SMART id: smartctl shows several distinct
+        # attributes as Unknown_Attribute, and names differ between vendors
+        self.db_conn.executemany('''
+            INSERT INTO attribute_defs (id, name) VALUES (?, ?)
+            ON CONFLICT (id) DO UPDATE SET name = excluded.name
+            WHERE name != excluded.name
+        ''', [(attribute['id'], attribute['attribute']) for attribute in smart_data])
+        
+        rows = [
+            (
                 timestamp,
                 device,
-                attribute['attribute'],
+                attribute['id'],
                 attribute['value'],
                 attribute['threshold'],
-                attribute['raw_value']
-            ))
+                attribute['raw_value'],
+                attribute['raw_int']
+            )
+            for attribute in smart_data
+        ]
+        
+        # One multi-row INSERT per chunk instead of one statement per attribute
+        for start in range(0, len(rows), self.INSERT_CHUNK_ROWS):
+            chunk = rows[start:start + self.INSERT_CHUNK_ROWS]
+            self.db_conn.execute(
+                self._insert_smart_sql[len(chunk)],
+                [field for row in chunk for field in row]
+            )
+
+    def store_prediction(self, device: str, health_score: float, confidence: float):
+        """Store a health prediction. Does not commit, like store_smart_data."""
+        self.db_conn.execute('''
+            INSERT INTO disk_predictions
+            (timestamp, device, health_score, prediction_confidence)
+            VALUES (?, ?, ?, ?)
+        ''', (
+            int(time.time()),
+            device,
+            health_score,
+            confidence
+        ))
+
+    def _load_models(self) -> Dict[str, Dict]:
+        """Load cached Isolation Forest models persisted by a previous run."""
+        try:
+            return joblib.load(self._model_path)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            self.logger.warning("Ignoring unreadable model cache %s: %s", self._model_path, e)
+            return {}
+
+    def _smart_history(self, device: str, since: Optional[int] = None) -> Tuple[np.ndarray, List[Tuple[int, str]], np.ndarray]:
+        """
+        Fetch a device's last HISTORY_SAMPLES samples, or those after `since`, as a float32 matrix.
+        Returns (timestamps, columns, values) with columns as (attribute_id, "value" | "raw")
+        """
+        cursor = self.db_conn.cursor()
+        if since is None:
+            cursor.execute('''
+                SELECT timestamp, attribute_id, value, COALESCE(raw_int, 0)
+                FROM smart_data
+                WHERE device = ? AND timestamp >= (
+                    SELECT MIN(timestamp) FROM (
+                        SELECT DISTINCT timestamp
+                        FROM smart_data
+                        WHERE device = ?
+                        ORDER BY timestamp DESC
+                        LIMIT ?
+                    )
+                )
+            ''', (device, device, self.HISTORY_SAMPLES))
+        else:
+            cursor.execute('''
+                SELECT timestamp, attribute_id, value, COALESCE(raw_int, 0)
+                FROM smart_data
+                WHERE device = ? AND timestamp >= ?
+            ''', (device, since))
+        
+        # Read the rows straight into a structured array, then scatter them
+        # into the sample matrix instead of going through a DataFrame pivot
+        rows = np.fromiter(cursor, dtype=_SMART_ROW)
+        if not len(rows):
+            return np.empty(0, dtype=np.int64), [], np.empty((0, 0), dtype=np.float32)
         
-        self.db_conn.commit()
+        timestamps, sample_idx = np.unique(rows['timestamp'], return_inverse=True)
+        attribute_ids, attribute_idx = np.unique(rows['attribute_id'], return_inverse=True)
+        n_attributes = len(attribute_ids)
+        
+        raw = np.full((len(timestamps), n_attributes), np.nan)
+        raw[sample_idx, attribute_idx] = rows['raw_int']
+        # Usage counters become their increase per hour; unknown for the first sample
+        counters = np.isin(attribute_ids, _USAGE_COUNTERS)
+        raw[1:, counters] = np.diff(raw[:, counters], axis=0) * 3600 / np.diff(timestamps)[:, None]
+        raw[0, counters] = np.nan
+        
+        matrix = np.full((len(timestamps), 2 * n_attributes), np.nan, dtype=np.float32)
+        matrix[sample_idx, attribute_idx] = rows['value']
+        matrix[:, n_attributes:] = raw
+        columns = [(a, "value") for a in attribute_ids.tolist()] + [(a, "raw") for a in attribute_ids.tolist()]
+        
+        # The sample at `since` was scored already; it was read for the rates
+        if since is not None and timestamps[0] == since:
+            return timestamps[1:], columns, matrix[1:]
+        return timestamps, columns, matrix
+
+    def _fit_model(self, device: str, attributes: List[Tuple[int, str]], values: np.ndarray) -> Optional[Dict]:
+        """
+        Fit an Isolation Forest on a device's history and persist it.
+        Returns None without fitting when the history is too small or has no
+        varying attribute, as the forest would only isolate noise.
+        """
+        try:
+            # Keep the attributes the disk reports now, then drop incomplete
+            # samples; attributes that never change are not forest features
+            if len(values):
+                present = ~np.isnan(values[-1])
+                values = values[:, present]
+                attributes = [a for a, keep in zip(attributes, present) if keep]
+            values = values[~np.isnan(values).any(axis=1)]
+            varying = np.ptp(values, axis=0) > 0 if len(values) else np.zeros(len(attributes), dtype=bool)
+            n_samples, n_features = values[:, varying].shape
+            if n_samples < self.MIN_FIT_SAMPLES or not n_features:
+                return None
+            
+            iso_forest = clone(_ISO_FOREST).set_params(max_samples=min(256, n_samples))
+            iso_forest.fit(values[:, varying])
+            
+            entry = {
+                'model': iso_forest,
+                'score_floor': float(iso_forest.score_samples(values[:, varying]).min()),
+                'columns': [a for a, keep in zip(attributes, varying) if keep],
+                # Quiet attributes, e.g. reallocated and pending sector counts
+                # on a healthy disk, with the value they held
+                'constants': {
+                    a: float(value)
+                    for a, keep, value in zip(attributes, varying, values[-1])
+                    if not keep and a[0] not in _USAGE_COUNTERS + _READINGS
+                },
+                'n_values': n_samples * n_features,
+                'fitted_at': time.time()
+            }
+            with self._model_lock:
+                self._models[device] = entry
+                joblib.dump(self._models, self._model_path)
+            return entry
+        finally:
+            self._refitting.discard(device)
+
+    def _refit_in_background(self, device: str):
+        """Refit a device's model in a worker thread; scoring keeps the old one meanwhile."""
+        if device in self._refitting:
+            return
+        
+        # The history is read here because the connection belongs to this thread
+        _, attributes, values = self._smart_history(device)
+        self._refitting.add(device)
+        threading.Thread(
+            target=self._fit_model,
+            args=(device, attributes, values),
+            name=f"refit-{device}",
+            daemon=True
+        ).start()
+
+    @staticmethod
+    def _anomaly_health(scores: np.ndarray, offset: float, floor: float) -> np.ndarray:
+        """Per-sample health: 1 for inliers, 0.75 at the training window's worst score `floor`."""
+        spread = max(offset - floor, 1e-6)
+        health = 1.0 - 0.25 * (offset - scores) / spread
+        return np.clip(health, 0.0, 1.0)
+
+    def _threshold_health(self, device: str, timestamp: int) -> float:
+        """Health of a sample: 0 if any attribute is at or below its failure threshold (FAILING_NOW), else 1."""
+        failing = self.db_conn.execute('''
+            SELECT 1
+            FROM smart_data
+            WHERE device = ? AND timestamp = ? AND threshold > 0 AND value <= threshold
+            LIMIT 1
+        ''', (device, timestamp)).fetchone()
+        return 0.0 if failing else 1.0
 
     def predict_disk_health(self, device: str) -> Tuple[float, float]:
         """
         Predict disk health using historical SMART data and machine learning.
+        Only samples stored since the previous prediction are scored; the
+        model itself is refitted at most every `model_refit_interval` seconds.
         Returns (health_score, prediction_confidence)
         """
         cursor = self.db_conn.cursor()
         
-        # Get historical SMART data for analysis
         cursor.execute('''
-            SELECT attribute, value, threshold
-            FROM smart_data
-            WHERE device = ?
-            ORDER BY timestamp DESC
-            LIMIT 1000
+            SELECT last_ts FROM prediction_state WHERE device = ?
         ''', (device,))
+        row = cursor.fetchone()
+        timestamps, attributes, values = self._smart_history(device, since=row[0] if row else None)
+        if not len(timestamps):
+            return 1.0, 0.0  # Default to healthy if no new data
         
-        data = cursor.fetchall()
-        if not data:
-            return 1.0, 0.0  # Default to healthy if no data
-            
-        # Prepare data for anomaly detection
-        df = pd.DataFrame(data, columns=['attribute', 'value', 'threshold'])
-        df_pivot = df.pivot(columns='attribute', values='value')
+        entry = self._models.get(device)
+        if entry is None or not set(entry['columns']) | set(entry['constants']) <= set(attributes):
+            # First prediction for this device (or its attribute set changed):
+            # fit synchronously on the warm-up window, if it is large enough
+            self._refitting.add(device)
+            _, history_attributes, history = self._smart_history(device)
+            entry = self._fit_model(device, history_attributes, history)
+            n_values = entry['n_values'] if entry else np.count_nonzero(~np.isnan(history))
+        else:
+            n_values = entry['n_values']
+            if time.time() - entry['fitted_at'] > self.config.get("model_refit_interval", 86400):
+                self._refit_in_background(device)
         
-        # Use Isolation Forest for anomaly detection
-        iso_forest = IsolationForest(contamination=0.1, random_state=42)
-        scores = iso_forest.fit_predict(df_pivot)
+        # An attribute at its failure threshold overrides the model
+        health_score = self._threshold_health(device, int(timestamps[-1]))
+        if entry is not None:
+            features = values[:, [attributes.index(a) for a in entry['columns']]]
+            complete = ~np.isnan(features).any(axis=1)
+            if complete.any():
+                # Score only, no refit
+                scores = entry['model'].score_samples(features[complete])
+                health = self._anomaly_health(scores, entry['model'].offset_, entry['score_floor'])
+                
+                # The forest cannot split on attributes that were constant in
+                # training, so any change in them counts as fully anomalous
+                quiet = values[complete][:, [attributes.index(a) for a in entry['constants']]]
+                changed = np.abs(quiet - np.fromiter(entry['constants'].values(), dtype=np.float32)) > 0
+                health[changed.any(axis=1)] = 0.0
+                health_score = min(health_score, float(health.mean()))
         
-        # Convert scores to health score (0 to 1)
-        health_score = (scores + 1).mean() / 2
+        cursor.execute('''
+            INSERT OR REPLACE INTO prediction_state (device, last_ts)
+            VALUES (?, ?)
+        ''', (device, int(timestamps[-1])))
         
         # Calculate prediction confidence based on data quantity
-        prediction_confidence = min(len(data) / 100, 1.0)
+        prediction_confidence = min(n_values / 100, 1.0)
         
-        return float(health_score), prediction_confidence
+        return health_score, prediction_confidence
+
+    def _read_mounts(self) -> Dict[str, str]:
+        """Map each mounted block device to its first mount point."""
+        self._mounts_file.seek(0)
+        mounts = {}
+        for line in self._mounts_file.read().splitlines():
+            source, target = line.split()[:2]
+            if source.startswith("/dev/"):
+                target = _MOUNTS_ESCAPE.sub(lambda m: chr(int(m.group(1), 8)), target)
+                mounts.setdefault(os.path.realpath(source), target)
+        return mounts
+
+    def _mount_points(self, device: str) -> List[str]:
+        """Mount points of a device and of its partitions."""
+        if any(mask & (select.POLLPRI | select.POLLERR) for _, mask in self._mounts_poll.poll(0)):
+            self._mounts = self._read_mounts()
+        
+        partition = self._partition_patterns.get(device)
+        if partition is None:
+            partition = re.compile(re.escape(os.path.realpath(device)) + r"(p?\d+)?")
+            self._partition_patterns[device] = partition
+        return [target for source, target in self._mounts.items() if partition.fullmatch(source)]
 
     def check_disk_space(self, device: str) -> Dict:
-        """Check disk space usage."""
+        """Check disk space usage (in KB, like df) across a device's mounted filesystems."""
+        mount_points = self._mount_points(device)
+        if not mount_points:
+            return {}
+        
+        total = used = available = 0
         try:
-            df = subprocess.run(['df', device], capture_output=True, text=True, check=True)
-            lines = df.stdout.strip().split('\n')
-            if len(lines) >= 2:
-                _, total, used, available, percent, _ = lines[1].split()
-                return {
-                    'total': int(total),
-                    'used': int(used),
-                    'available': int(available),
-                    'usage_percent': float(percent.strip('%'))
-                }
-        except subprocess.CalledProcessError as e:
-            self.logger.error(f"Failed to check disk space for {device}: {e}")
-        return {}
+            for mount_point in mount_points:
+                usage = shutil.disk_usage(mount_point)
+                total += usage.total // 1024
+                used += usage.used // 1024
+                available += usage.free // 1024
+        except OSError as e:
+            self.logger.error("Failed to check disk space for %s: %s", device, e)
+            return {}
+        
+        return {
+            'total': total,
+            'used': used,
+            'available': available,
+            # Rounded up to a whole percent, as df reports it
+            'usage_percent': float(math.ceil(100 * used / (used + available))) if used + available else 0.0
+        }
+
+    async def _log_rsync_progress(self, stream: asyncio.StreamReader):
+        """Log rsync's --info=progress2 updates, which are separated by carriage returns."""
+        pending = b""
+        while True:
+            chunk = await stream.read(4096)
+            if not chunk:
+                break
+            *lines, pending = re.split(rb"[\r\n]", pending + chunk)
+            for line in lines:
+                if line.strip():
+                    self.logger.debug("rsync progress: %s", line.decode(errors="replace").strip())
 
-    def backup_critical_data(self, source_device: str):
+    async def _rsync(self, source: str, destination: str):
+        """
+        Copy a directory tree with rsync, streaming its output into the log
+        and stopping it at the first read error from the (failing) source.
+        """
+        cmd = [
+            "rsync",
+            "-aHAX",
+            "--inplace",
+            "--whole-file",
+            "--partial",
+            "--info=progress2",
+            source,
+            destination
+        ]
+        process = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        progress = asyncio.ensure_future(self._log_rsync_progress(process.stdout))
+        aborted = False
+        try:
+            async for line in process.stderr:
+                message = line.decode(errors="replace").rstrip()
+                self.logger.info("rsync: %s", message)
+                if "Input/output error" in message and not aborted:
+                    self.logger.error("Read error on %s, aborting backup", source)
+                    aborted = True
+                    self._terminate(process)
+            await progress
+            returncode = await process.wait()
+        except asyncio.CancelledError:
+            self._terminate(process)
+            await process.wait()
+            progress.cancel()
+            raise
+        
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, cmd)
+
+    @staticmethod
+    def _terminate(process: asyncio.subprocess.Process):
+        """Terminate a subprocess that may already have exited."""
+        try:
+            process.terminate()
+        except ProcessLookupError:
+            pass
+
+    async def backup_critical_data(self, source_device: str):
         """Perform backup of critical data when health score is low."""
+        device_name = os.path.basename(source_device)
         backup_path = os.path.join(
             self.config["backup_location"],
-            f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+            f"backup_{device_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
         )
         
         try:
             # Create backup directory
             os.makedirs(backup_path, exist_ok=True)
             
-            # Mount source device to temporary location
-            mount_point = "/tmp/disksentry_backup"
+            # Mount source device to temporary location (one per device, as
+            # backups of different devices may run concurrently)
+            mount_point = f"/tmp/disksentry_backup_{device_name}"
             os.makedirs(mount_point, exist_ok=True)
             
-            # Mount the device
-            subprocess.run(["mount", source_device, mount_point], check=True)
+            # Mount the device read-only so nothing writes to a failing drive
+            await self._run(["mount", "-o", "ro", source_device, mount_point])
+            try:
+                # Perform backup using rsync
+                await self._rsync(f"{mount_point}/", backup_path)
+            finally:
+                # Unmount the device, also when rsync failed or was cancelled
+                await self._run(["umount", mount_point])
             
-            # Perform backup using rsync
-            subprocess.run([
-                "rsync",
-                "-av",
-                "--progress",
-                f"{mount_point}/",
-                backup_path
-            ], check=True)
+            self.logger.info("Backup completed successfully to %s", backup_path)
             
-            # Unmount the device
-            subprocess.run(["umount", mount_point], check=True)
+        except Exception as e:
+            self.logger.error("Backup failed: %s", e)
+            raise
+
+    async def _poll_device(self, device: str, delay: float = 0.0):
+        """Collect, store and score one device's SMART data; back up if unhealthy."""
+        await asyncio.sleep(delay)
+        try:
+            smart_data = await self.get_smart_data(device)
+            if not smart_data:
+                return
+            
+            # SMART rows and prediction are committed together in one transaction
+            with self.db_conn:
+                self.store_smart_data(device, smart_data)
+                health_score, confidence = self.predict_disk_health(device)
+                self.store_prediction(device, health_score, confidence)
+            self._report_blocks.pop(device, None)
             
-            self.logger.info(f"Backup completed successfully to {backup_path}")
+            if self.logger.isEnabledFor(logging.INFO):
+                self.logger.info(
+                    "Device: %s, Health Score: %.2f, Confidence: %.2f",
+                    device, health_score, confidence
+                )
             
+            # Check if backup is needed
+            if health_score < self.config["backup_threshold"]:
+                self._start_backup(device, health_score)
         except Exception as e:
-            self.logger.error(f"Backup failed: {e}")
-            raise
+            self.logger.error("Error monitoring device %s: %s", device, e)
+
+    def _start_backup(self, device: str, health_score: float):
+        """Start a backup task for a device unless one is already running."""
+        task = self._backup_tasks.get(device)
+        if task is not None and not task.done():
+            self.logger.info("Backup of %s still in progress", device)
+            return
+        
+        self.logger.warning(
+            "Low health score (%s) detected for %s. Initiating backup...",
+            health_score, device
+        )
+        self._backup_tasks[device] = asyncio.create_task(self._backup_device(device))
+
+    async def _backup_device(self, device: str):
+        """Run a backup task; failures are logged by backup_critical_data."""
+        try:
+            await self.backup_critical_data(device)
+        except Exception:
+            pass
 
-    def monitor_loop(self):
+    def _optimize_database(self):
+        """Refresh the query planner's statistics as smart_data grows."""
+        try:
+            self.db_conn.execute("PRAGMA optimize")
+            self.db_conn.execute("ANALYZE")
+        except sqlite3.Error as e:
+            self.logger.error("Database optimization failed: %s", e)
+
+    async def monitor_loop(self):
         """Main monitoring loop."""
+        loop = asyncio.get_running_loop()
+        next_tick = last_optimize = loop.time()
         while True:
-            for device in self.config["monitored_disks"]:
-                try:
-                    # Collect SMART data
-                    smart_data = self.get_smart_data(device)
-                    if smart_data:
-                        self.store_smart_data(device, smart_data)
-                        
-                        # Predict health
-                        health_score, confidence = self.predict_disk_health(device)
-                        
-                        # Store prediction
-                        cursor = self.db_conn.cursor()
-                        cursor.execute('''
-                            INSERT INTO disk_predictions
-                            (timestamp, device, health_score, prediction_confidence)
-                            VALUES (?, ?, ?, ?)
-                        ''', (
-                            datetime.now().isoformat(),
-                            device,
-                            health_score,
-                            confidence
-                        ))
-                        self.db_conn.commit()
-                        
-                        # Check if backup is needed
-                        if health_score < self.config["backup_threshold"]:
-                            self.logger.warning(
-                                f"Low health score ({health_score}) detected for {device}. "
-                                "Initiating backup..."
-                            )
-                            self.backup_critical_data(device)
-                        
-                        self.logger.info(
-                            f"Device: {device}, Health Score: {health_score:.2f}, "
-                            f"Confidence: {confidence:.2f}"
-                        )
-                    
-                except Exception as e:
-                    self.logger.error(f"Error monitoring device {device}: {e}")
-                
-            # Wait for next check interval
-            time.sleep(self.config["smart_check_interval"])
+            disks = self.config["monitored_disks"]
+            interval = self.config["smart_check_interval"]
+            
+            # Poll all devices concurrently, but stagger their start over the
+            # check interval so smartctl only ever stalls one disk's I/O queue
+            # at a time
+            stagger = interval / max(len(disks), 1)
+            await asyncio.gather(
+                *(self._poll_device(device, i * stagger) for i, device in enumerate(disks))
+            )
+            
+            if loop.time() - last_optimize >= self.OPTIMIZE_INTERVAL:
+                self._optimize_database()
+                last_optimize = loop.time()
+            
+            # Cycles start on a fixed monotonic schedule, however long the
+            # polls took; ticks missed while overloaded are skipped, not queued
+            next_tick += interval
+            behind = loop.time() - next_tick
+            if behind > 0:
+                missed = int(behind // interval) + 1
+                self.logger.warning(
+                    "Monitoring is falling behind by %.1fs; skipping %d check interval(s)",
+                    behind, missed
+                )
+                next_tick += missed * interval
+            await asyncio.sleep(next_tick - loop.time())
+
+    def _device_report(self, device: str) -> List[str]:
+        """Report lines for one device, cached for a check interval or until its next prediction."""
+        cached = self._report_blocks.get(device)
+        if cached is not None:
+            built_at, block = cached
+            if time.monotonic() - built_at < self.config["smart_check_interval"]:
+                return block
+        
+        block = [f"Device: {device}"]
+        
+        # Get latest health score
+        cursor = self.db_conn.cursor()
+        cursor.execute('''
+            SELECT health_score, prediction_confidence
+            FROM disk_predictions
+            WHERE device = ?
+            ORDER BY timestamp DESC
+            LIMIT 1
+        ''', (device,))
+        
+        health_data = cursor.fetchone()
+        if health_data:
+            health_score, confidence = health_data
+            block.append(f"Health Score: {health_score:.2f}")
+            block.append(f"Prediction Confidence: {confidence:.2f}")
+        
+        # Add space usage
+        space_info = self.check_disk_space(device)
+        if space_info:
+            block.append(f"Space Usage: {space_info['usage_percent']}%")
+            block.append(f"Available Space: {space_info['available']} KB")
+        
+        block.append("")  # Empty line between devices
+        self._report_blocks[device] = (time.monotonic(), block)
+        return block
 
     def generate_report(self) -> str:
         """Generate a health report for all monitored disks."""
@@ -280,46 +838,26 @@ class DiskSentry:
         report.append(f"Generated at: {datetime.now().isoformat()}\n")
         
         for device in self.config["monitored_disks"]:
-            report.append(f"Device: {device}")
-            
-            # Get latest health score
-            cursor = self.db_conn.cursor()
-            cursor.execute('''
-                SELECT health_score, prediction_confidence
-                FROM disk_predictions
-                WHERE device = ?
-                ORDER BY timestamp DESC
-                LIMIT 1
-            ''', (device,))
-            
-            health_data = cursor.fetchone()
-            if health_data:
-                health_score, confidence = health_data
-                report.append(f"Health Score: {health_score:.2f}")
-                report.append(f"Prediction Confidence: {confidence:.2f}")
-            
-            # Add space usage
-            space_info = self.check_disk_space(device)
-            if space_info:
-                report.append(f"Space Usage: {space_info['usage_percent']}%")
-                report.append(f"Available Space: {space_info['available']} KB")
-            
-            report.append("")  # Empty line between devices
+            report.extend(self._device_report(device))
         
         return "\n".join(report)
 
 def main():
     """Main entry point for DiskSentry."""
+    sentry = None
     try:
         sentry = DiskSentry()
         sentry.logger.info("DiskSentry started")
-        sentry.monitor_loop()
+        asyncio.run(sentry.monitor_loop())
     except KeyboardInterrupt:
         sentry.logger.info("DiskSentry shutting down")
         sys.exit(0)
     except Exception as e:
-        sentry.logger.error(f"Fatal error: {e}")
+        sentry.logger.error("Fatal error: %s", e)
         sys.exit(1)
+    finally:
+        if sentry is not None:
+            sentry.close()
 
 if __name__ == "__main__":
     main()
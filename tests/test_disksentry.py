@@ -1,8 +1,15 @@
+import asyncio
 import unittest
-from unittest.mock import patch, mock_open, MagicMock
+from unittest.mock import patch, mock_open, MagicMock, AsyncMock
 import os
+import shutil
+import tempfile
+import time
+import subprocess
 import sqlite3
 import json
+import logging
+import numpy as np
 from disksentry import DiskSentry
 
 class TestDiskSentry(unittest.TestCase):
@@ -61,3 +68,325 @@ class TestDiskSentry(unittest.TestCase):
             )''') 
         self.assertEqual(conn, mock_conn)
 
+
+class TestDiskSentryStorage(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        config_path = os.path.join(self.tmpdir, "config.json")
+        with open(config_path, 'w') as f:
+            json.dump({
+                "monitored_disks": ["/dev/sda"],
+                "backup_location": os.path.join(self.tmpdir, "backup"),
+                "smart_check_interval": 3600,
+                "backup_threshold": 0.7,
+                "database_path": os.path.join(self.tmpdir, "disk_health.db")
+            }, f)
+        self.ds = DiskSentry(config_path)
+        self.smart_data = [
+            {'id': 1, 'attribute': 'Raw_Read_Error_Rate', 'value': 100, 'threshold': 6, 'raw_value': '0', 'raw_int': 0},
+            {'id': 194, 'attribute': 'Temperature_Celsius', 'value': 64, 'threshold': 0,
+             'raw_value': '36 (Min/Max 20/45)', 'raw_int': 36},
+        ]
+
+    def tearDown(self):
+        self.ds.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_close_detaches_log_listener(self):
+        logger = logging.getLogger("DiskSentry")
+        other = DiskSentry(os.path.join(self.tmpdir, "config.json"))
+        self.assertIn(other._log_handler, logger.handlers)
+        other.close()
+        self.assertNotIn(other._log_handler, logger.handlers)
+        self.assertIsNone(other._log_listener._thread)
+
+    def test_store_smart_data_in_single_transaction(self):
+        with self.ds.db_conn:
+            self.ds.store_smart_data("/dev/sda", self.smart_data)
+            self.assertTrue(self.ds.db_conn.in_transaction)
+        self.assertFalse(self.ds.db_conn.in_transaction)
+
+        rows = self.ds.db_conn.execute(
+            "SELECT name, value, threshold FROM smart_data "
+            "JOIN attribute_defs ON attribute_defs.id = smart_data.attribute_id ORDER BY name"
+        ).fetchall()
+        self.assertEqual(rows, [("Raw_Read_Error_Rate", 100, 6), ("Temperature_Celsius", 64, 0)])
+
+    def test_database_uses_wal(self):
+        mode = self.ds.db_conn.execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(mode, "wal")
+
+    def _store_samples(self, count, start=0):
+        for i in range(start, start + count):
+            with self.ds.db_conn:
+                self.ds.db_conn.executemany(
+                    "INSERT INTO smart_data VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(1704067200 + i * 3600, "/dev/sda", attr["id"],
+                      attr["value"] - i % 3, attr["threshold"], attr["raw_value"], attr["raw_int"])
+                     for attr in self.smart_data]
+                )
+
+    def test_predict_reuses_cached_model(self):
+        self._store_samples(60)
+        health_score, confidence = self.ds.predict_disk_health("/dev/sda")
+        self.assertTrue(0.0 <= health_score <= 1.0)
+        self.assertEqual(confidence, 1.0)
+        self.assertTrue(os.path.exists(self.ds._model_path))
+        model = self.ds._models["/dev/sda"]["model"]
+
+        self._store_samples(1, start=60)
+        with patch.object(self.ds, "_fit_model") as mock_fit:
+            self.ds.predict_disk_health("/dev/sda")
+        mock_fit.assert_not_called()
+        self.assertIs(self.ds._models["/dev/sda"]["model"], model)
+
+    def test_get_smart_data_parses_json(self):
+        self.ds._run = AsyncMock(return_value=MagicMock(returncode=0, stdout=json.dumps({
+            "ata_smart_attributes": {"table": [
+                {"id": 194, "name": "Temperature_Celsius", "value": 64, "worst": 40, "thresh": 0,
+                 "raw": {"value": 193275101220, "string": "36 (Min/Max 20/45)"}},
+                {"id": 9, "name": "Power_On_Hours", "value": 87, "worst": 87, "thresh": 0,
+                 "raw": {"value": 11712, "string": "11712h+05m+06.789s"}}
+            ]}
+        })))
+        smart_data = asyncio.run(self.ds.get_smart_data("/dev/sda"))
+        self.assertEqual(smart_data, [{
+            'id': 194, 'attribute': 'Temperature_Celsius', 'value': 64, 'threshold': 0,
+            'raw_value': '36 (Min/Max 20/45)', 'raw_int': 36
+        }, {
+            'id': 9, 'attribute': 'Power_On_Hours', 'value': 87, 'threshold': 0,
+            'raw_value': '11712h+05m+06.789s', 'raw_int': 11712
+        }])
+
+    def test_poll_device_stores_prediction_and_starts_backup(self):
+        self.ds.get_smart_data = AsyncMock(return_value=self.smart_data)
+        self.ds.predict_disk_health = MagicMock(return_value=(0.5, 1.0))
+        self.ds.backup_critical_data = AsyncMock()
+
+        async def poll():
+            await self.ds._poll_device("/dev/sda")
+            await self.ds._backup_tasks["/dev/sda"]
+
+        asyncio.run(poll())
+        self.ds.backup_critical_data.assert_awaited_once_with("/dev/sda")
+        rows = self.ds.db_conn.execute(
+            "SELECT device, health_score FROM disk_predictions"
+        ).fetchall()
+        self.assertEqual(rows, [("/dev/sda", 0.5)])
+
+    def test_setup_database_converts_iso_timestamps(self):
+        self.ds.db_conn.close()
+        db_path = self.ds.config["database_path"]
+        os.remove(db_path)
+        with sqlite3.connect(db_path) as conn:
+            conn.execute("CREATE TABLE smart_data (timestamp TEXT, device TEXT, attribute TEXT, "
+                         "value INTEGER, threshold INTEGER, raw_value TEXT)")
+            conn.execute("CREATE TABLE disk_predictions (timestamp TEXT, device TEXT, "
+                         "health_score REAL, prediction_confidence REAL)")
+            conn.execute("INSERT INTO smart_data VALUES ('2024-01-01T12:00:00.123456', '/dev/sda', "
+                         "'Temperature_Celsius', 64, 0, '36 (Min/Max 20/45)')")
+            conn.execute("INSERT INTO disk_predictions VALUES ('2024-01-01T12:00:00.123456', '/dev/sda', 0.9, 1.0)")
+        conn.close()
+
+        self.ds.db_conn = self.ds._setup_database()
+        row = self.ds.db_conn.execute("SELECT timestamp, typeof(timestamp) FROM disk_predictions").fetchone()
+        self.assertEqual(row[1], "integer")
+        self.assertAlmostEqual(row[0], 1704110400, delta=14 * 3600)
+        self.assertEqual(self.ds.db_conn.execute("PRAGMA user_version").fetchone()[0], DiskSentry.SCHEMA_VERSION)
+        row = self.ds.db_conn.execute(
+            "SELECT typeof(timestamp), name, value, raw_int FROM smart_data "
+            "JOIN attribute_defs ON attribute_defs.id = smart_data.attribute_id"
+        ).fetchone()
+        self.assertEqual(row, ("integer", "Temperature_Celsius", 64, 36))
+
+    @patch("shutil.disk_usage")
+    def test_check_disk_space_sums_partitions(self, mock_usage):
+        self.ds._mounts = {"/dev/sda1": "/", "/dev/sda2": "/home", "/dev/sdab1": "/srv"}
+        mock_usage.return_value = shutil._ntuple_diskusage(4096 * 1024, 1024 * 1024, 2048 * 1024)
+        space_info = self.ds.check_disk_space("/dev/sda")
+        self.assertEqual(mock_usage.call_count, 2)
+        self.assertEqual(space_info, {'total': 8192, 'used': 2048, 'available': 4096, 'usage_percent': 34.0})
+
+        pattern = self.ds._partition_patterns["/dev/sda"]
+        self.ds.check_disk_space("/dev/sda")
+        self.assertIs(self.ds._partition_patterns["/dev/sda"], pattern)
+
+    def test_predict_without_enough_history_uses_thresholds(self):
+        # Healthy WD / Seagate-style attributes close to their thresholds
+        self.smart_data = [
+            {'id': 5, 'attribute': 'Reallocated_Sector_Ct', 'value': 200, 'threshold': 140, 'raw_value': '0', 'raw_int': 0},
+            {'id': 184, 'attribute': 'End-to-End_Error', 'value': 100, 'threshold': 99, 'raw_value': '0', 'raw_int': 0},
+        ]
+        self._store_samples(10)
+        with patch("disksentry.IsolationForest") as mock_forest:
+            health_score, _ = self.ds.predict_disk_health("/dev/sda")
+        mock_forest.assert_not_called()
+        self.assertNotIn("/dev/sda", self.ds._models)
+        self.assertEqual(health_score, 1.0)
+
+        # End-to-End_Error drops to its threshold: FAILING_NOW
+        self.smart_data[1]['value'] = 99
+        self._store_samples(1, start=12)
+        health_score, _ = self.ds.predict_disk_health("/dev/sda")
+        self.assertEqual(health_score, 0.0)
+
+    def test_rsync_aborts_on_read_error(self):
+        create_subprocess_exec = asyncio.create_subprocess_exec
+
+        async def fake_rsync(*cmd, **kwargs):
+            script = "echo 'rsync: read errors mapping \"/f\": Input/output error (5)' >&2; exec sleep 30"
+            return await create_subprocess_exec("sh", "-c", script, **kwargs)
+
+        with patch("asyncio.create_subprocess_exec", side_effect=fake_rsync):
+            start = time.monotonic()
+            with self.assertRaises(subprocess.CalledProcessError):
+                asyncio.run(self.ds._rsync("/mnt/src/", "/mnt/backup"))
+        self.assertLess(time.monotonic() - start, 10)
+
+    def test_generate_report_is_cached_until_next_prediction(self):
+        self.ds.get_smart_data = AsyncMock(return_value=self.smart_data)
+        self.ds.predict_disk_health = MagicMock(return_value=(0.9, 1.0))
+        asyncio.run(self.ds._poll_device("/dev/sda"))
+
+        with patch.object(self.ds, "check_disk_space", return_value={}) as mock_space:
+            self.assertIn("Health Score: 0.90", self.ds.generate_report())
+            self.ds.generate_report()
+            self.assertEqual(mock_space.call_count, 1)
+
+            self.ds.predict_disk_health.return_value = (0.8, 1.0)
+            with patch("time.time", return_value=time.time() + 60):
+                asyncio.run(self.ds._poll_device("/dev/sda"))
+            self.assertIn("Health Score: 0.80", self.ds.generate_report())
+            self.assertEqual(mock_space.call_count, 2)
+
+    def test_monitor_loop_keeps_a_fixed_schedule(self):
+        self.ds.config["smart_check_interval"] = 0.2
+        starts = []
+
+        async def slow_poll(device, delay):
+            starts.append(asyncio.get_running_loop().time())
+            await asyncio.sleep(0.1)
+
+        self.ds._poll_device = slow_poll
+
+        async def run():
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(self.ds.monitor_loop(), 0.7)
+
+        asyncio.run(run())
+        self.assertEqual(len(starts), 4)
+        for i, start in enumerate(starts):
+            self.assertAlmostEqual(start - starts[0], i * 0.2, delta=0.05)
+
+    def test_in_distribution_samples_stay_healthy(self):
+        rng = np.random.default_rng(0)
+        for i in range(300):
+            if i == 200:
+                # Fit on the first 200 samples, then score one sample per cycle
+                self.ds.predict_disk_health("/dev/sda")
+                self.assertIn("/dev/sda", self.ds._models)
+            with self.ds.db_conn:
+                self.ds.db_conn.executemany(
+                    "INSERT INTO smart_data VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(1704067200 + i * 3600, "/dev/sda", 1, int(rng.normal(100, 2)), 6, "0", 0),
+                     (1704067200 + i * 3600, "/dev/sda", 2, int(rng.normal(64, 3)), 0, "36", 36)]
+                )
+            if i >= 200:
+                health_score, _ = self.ds.predict_disk_health("/dev/sda")
+                self.assertGreaterEqual(health_score, self.ds.config["backup_threshold"])
+
+    def test_attributes_with_the_same_name_stay_distinct(self):
+        smart_data = [
+            {'id': 170, 'attribute': 'Unknown_Attribute', 'value': 100, 'threshold': 10, 'raw_value': '0', 'raw_int': 0},
+            {'id': 174, 'attribute': 'Unknown_Attribute', 'value': 90, 'threshold': 0, 'raw_value': '7', 'raw_int': 7},
+        ]
+        with self.ds.db_conn:
+            self.ds.store_smart_data("/dev/sda", smart_data)
+        _, columns, values = self.ds._smart_history("/dev/sda")
+        self.assertEqual(columns[:2], [(170, "value"), (174, "value")])
+        self.assertEqual(values[0, :2].tolist(), [100, 90])
+        names = self.ds.db_conn.execute("SELECT id, name FROM attribute_defs ORDER BY id").fetchall()
+        self.assertEqual(names, [(170, 'Unknown_Attribute'), (174, 'Unknown_Attribute')])
+
+    def test_rsync_progress_goes_to_the_log(self):
+        create_subprocess_exec = asyncio.create_subprocess_exec
+
+        async def fake_rsync(*cmd, **kwargs):
+            script = "printf '  1,024  50%%  1.00MB/s\\r  2,048 100%%  1.00MB/s\\n'"
+            return await create_subprocess_exec("sh", "-c", script, **kwargs)
+
+        with patch("asyncio.create_subprocess_exec", side_effect=fake_rsync):
+            with self.assertLogs("DiskSentry", level="DEBUG") as logs:
+                asyncio.run(self.ds._rsync("/mnt/src/", "/mnt/backup"))
+        self.assertEqual(logs.output, [
+            "DEBUG:DiskSentry:rsync progress: 1,024  50%  1.00MB/s",
+            "DEBUG:DiskSentry:rsync progress: 2,048 100%  1.00MB/s",
+        ])
+
+    def test_generate_report_cache_expires_after_check_interval(self):
+        with patch.object(self.ds, "check_disk_space", return_value={}) as mock_space:
+            self.ds.generate_report()
+            self.ds.generate_report()
+            self.assertEqual(mock_space.call_count, 1)
+
+            with patch("time.monotonic", return_value=time.monotonic() + 3600):
+                self.ds.generate_report()
+            self.assertEqual(mock_space.call_count, 2)
+
+    def _store_wd_sample(self, i, rng, changes=None):
+        # A healthy WD drive: counters grow every hour, temperature jitters
+        table = {
+            1: (200, 51, 0), 3: (178, 21, 6083), 4: (100, 0, 1342), 5: (200, 140, 0),
+            7: (200, 0, 0), 9: (85, 0, 11712 + i), 10: (100, 0, 0), 12: (100, 0, 1340),
+            192: (200, 0, 1093), 193: (187, 0, 40215 + 2 * i + int(rng.integers(0, 2))),
+            194: (114, 0, int(rng.normal(36, 1.5))), 196: (200, 0, 0), 197: (200, 0, 0),
+            198: (100, 0, 0), 199: (200, 0, 0), 200: (200, 0, 0)
+        }
+        table.update(changes or {})
+        with self.ds.db_conn:
+            self.ds.db_conn.executemany(
+                "INSERT INTO smart_data VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(1704067200 + i * 3600, "/dev/sda", attribute_id, value, threshold, str(raw), raw)
+                 for attribute_id, (value, threshold, raw) in table.items()]
+            )
+
+    def test_usage_counters_do_not_age_the_disk(self):
+        rng = np.random.default_rng(1)
+        for i in range(240):
+            if i == 120:
+                # Fit on the first 120 samples, then score one sample per cycle
+                self.ds.predict_disk_health("/dev/sda")
+                self.assertIn("/dev/sda", self.ds._models)
+            self._store_wd_sample(i, rng)
+            if i >= 120:
+                health_score, _ = self.ds.predict_disk_health("/dev/sda")
+                self.assertGreaterEqual(health_score, self.ds.config["backup_threshold"])
+
+        _, columns, values = self.ds._smart_history("/dev/sda")
+        power_on_rate = values[:, columns.index((9, "raw"))]
+        self.assertTrue(np.isnan(power_on_rate[0]))
+        self.assertTrue((power_on_rate[1:] == 1.0).all())
+
+    def test_failing_attribute_overrides_cached_model(self):
+        rng = np.random.default_rng(2)
+        for i in range(120):
+            self._store_wd_sample(i, rng)
+        self.ds.predict_disk_health("/dev/sda")
+        self.assertIn("/dev/sda", self.ds._models)
+
+        # Spin_Up_Time is no model feature; at its threshold it is FAILING_NOW
+        self._store_wd_sample(120, rng, {3: (21, 21, 6083)})
+        self.assertEqual(self.ds.predict_disk_health("/dev/sda"), (0.0, 1.0))
+
+    def test_reallocated_sectors_lower_health(self):
+        rng = np.random.default_rng(3)
+        for i in range(121):
+            self._store_wd_sample(i, rng)
+        health_score, _ = self.ds.predict_disk_health("/dev/sda")
+        self.assertGreaterEqual(health_score, self.ds.config["backup_threshold"])
+        self.assertIn((5, "raw"), self.ds._models["/dev/sda"]["constants"])
+
+        # Still far above the threshold of 140, but sectors are being remapped
+        self._store_wd_sample(121, rng, {5: (199, 140, 8)})
+        health_score, _ = self.ds.predict_disk_health("/dev/sda")
+        self.assertLess(health_score, self.ds.config["backup_threshold"])